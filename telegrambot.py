@@ -1,19 +1,27 @@
 import os
 import re
 import json
+import codecs
 import asyncio
 import random
 from datetime import datetime
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Iterator, Tuple
 
-import requests
+import aiohttp
 import feedparser
+import xxhash
 import urllib.parse
 from aiogram import Bot
 from aiogram.client.bot import DefaultBotProperties
 from aiogram.enums import ParseMode
-from aiogram.types import FSInputFile
-from openai import OpenAI
+from aiogram.types import BufferedInputFile
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_random_exponential
+from selectolax.lexbor import LexborHTMLParser
+
+try:
+    import ahocorasick
+except ImportError:  # pyahocorasick не обязателен, см. iter_keywords
+    ahocorasick = None
 
 # ---------------- CONFIG (Все данные через ENV) ----------------
 
@@ -30,7 +38,12 @@ bot = Bot(
     token=TELEGRAM_BOT_TOKEN,
     default=DefaultBotProperties(parse_mode=ParseMode.HTML),
 )
-openai_client = OpenAI(api_key=OPENAI_API_KEY)
+# Запросы к OpenAI идут напрямую через общую aiohttp-сессию, без SDK
+OPENAI_CHAT_URL = "https://api.openai.com/v1/chat/completions"
+
+# Ограничение одновременных запросов к OpenAI и pollinations.ai
+openai_semaphore = asyncio.Semaphore(int(os.getenv("OAI_CONCURRENCY", "8")))
+image_semaphore = asyncio.Semaphore(int(os.getenv("IMAGE_CONCURRENCY", "4")))
 
 HEADERS = {
     "User-Agent": (
@@ -39,7 +52,23 @@ HEADERS = {
     )
 }
 
-POSTED_FILE = "posted_articles.json"
+# Общая aiohttp-сессия: создаётся лениво, уже внутри запущенного event loop.
+# Keep-alive и кэш DNS избавляют повторные запросы к тем же хостам от лишних TCP/TLS рукопожатий
+http_session: Optional[aiohttp.ClientSession] = None
+
+def get_session() -> aiohttp.ClientSession:
+    global http_session
+    if http_session is None or http_session.closed:
+        http_session = aiohttp.ClientSession(
+            headers=HEADERS,
+            connector=aiohttp.TCPConnector(limit=16, ttl_dns_cache=300, keepalive_timeout=60),
+        )
+    return http_session
+
+# Журнал опубликованного: одна JSON-запись на строку, новые посты дописываются в конец
+POSTED_FILE = "posted_articles.jsonl"
+# Старый формат (целиком перезаписываемый JSON-массив) — читается один раз для миграции
+LEGACY_POSTED_FILE = "posted_articles.json"
 RETENTION_DAYS = 7
 
 # Источник GitHub Trending
@@ -74,101 +103,232 @@ RUSSIA_KEYWORDS = ["россия", "рф", "российск", "москв", "р
 
 # ---------------- STATE ----------------
 
-if os.path.exists(POSTED_FILE):
+def link_id(link: str) -> int:
+    # 64-битный хеш вместо полного URL: компактнее и в памяти, и в журнале
+    return xxhash.xxh64_intdigest(link.encode())
+
+def stored_id(raw) -> int:
+    # Старые записи хранят сам URL — приводим к хешу при загрузке
+    return link_id(raw) if isinstance(raw, str) else raw
+
+def load_posted_articles() -> Tuple[Dict[int, Optional[float]], bool]:
+    # Возвращает записи и флаг "в журнале есть оборванные строки"
+    posted, damaged = {}, False
     with open(POSTED_FILE, "r", encoding="utf-8") as f:
-        try:
-            posted_data = json.load(f)
-            posted_articles = {item["id"]: item.get("timestamp") for item in posted_data}
-        except Exception:
-            posted_articles = {}
-else:
-    posted_articles = {}
+        for line in f:
+            # Запись без "\n" — оборванная, даже если сам JSON успел записаться целиком
+            if not line.endswith("\n"): damaged = True
+            try: item = json.loads(line)
+            except ValueError:
+                damaged = True
+                continue
+            # Более поздняя запись перекрывает раннюю
+            posted[stored_id(item["id"])] = item.get("timestamp")
+    return posted, damaged
 
 def save_posted_articles():
-    data = [{"id": i, "timestamp": ts} for i, ts in posted_articles.items()]
-    with open(POSTED_FILE, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    # Полная перезапись (компактизация) журнала. Пишем во временный файл и атомарно
+    # подменяем им журнал — падение посреди записи не оставит обрезанный файл
+    tmp = POSTED_FILE + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        for i, ts in posted_articles.items():
+            f.write(json.dumps({"id": i, "timestamp": ts}, ensure_ascii=False) + "\n")
+    os.replace(tmp, POSTED_FILE)
 
 def clean_old_posts():
     global posted_articles
     cutoff = datetime.now().timestamp() - (RETENTION_DAYS * 86400)
+    before = len(posted_articles)
     posted_articles = {i: ts for i, ts in posted_articles.items() if ts is None or ts > cutoff}
-    save_posted_articles()
+    # Ничего не устарело — журнал на диске уже актуален
+    if len(posted_articles) != before: save_posted_articles()
 
-def save_posted(article_id: str):
-    posted_articles[article_id] = datetime.now().timestamp()
+def save_posted(article_id: int):
+    ts = datetime.now().timestamp()
+    posted_articles[article_id] = ts
+    with open(POSTED_FILE, "a", encoding="utf-8") as f:
+        f.write(json.dumps({"id": article_id, "timestamp": ts}, ensure_ascii=False) + "\n")
+
+if os.path.exists(POSTED_FILE):
+    posted_articles, damaged = load_posted_articles()
+    # Иначе следующая дописанная запись склеится с оборванной строкой
+    if damaged: save_posted_articles()
+elif os.path.exists(LEGACY_POSTED_FILE):
+    with open(LEGACY_POSTED_FILE, "r", encoding="utf-8") as f:
+        try:
+            posted_data = json.load(f)
+            posted_articles = {stored_id(item["id"]): item.get("timestamp") for item in posted_data}
+        except Exception:
+            posted_articles = {}
     save_posted_articles()
+else:
+    posted_articles = {}
 
 # ---------------- HELPERS / PARSERS ----------------
 
-def safe_get(url: str) -> Optional[str]:
+# Сетевые ошибки aiohttp. Голый except здесь не годится: он перехватил бы и
+# asyncio.CancelledError, и корутина не завершилась бы при отмене
+HTTP_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError)
+
+# Тело ответа отдаётся байтами, без декодирования всей страницы в str
+async def fetch_body(url: str) -> Optional[Tuple[bytes, Optional[str]]]:
+    # Возвращает тело и кодировку из заголовка Content-Type (если указана)
     try:
-        resp = requests.get(url, headers=HEADERS, timeout=15)
-        return resp.text if resp.status_code == 200 else None
-    except: return None
+        async with get_session().get(url, timeout=aiohttp.ClientTimeout(total=15)) as resp:
+            return (await resp.read(), resp.charset) if resp.status == 200 else None
+    except HTTP_ERRORS: return None
+
+async def safe_get_bytes(url: str) -> Optional[bytes]:
+    # Для RSS: кодировку feedparser сам берёт из XML-заголовка
+    res = await fetch_body(url)
+    return res[0] if res else None
+
+async def safe_get_html(url: str) -> Optional[bytes]:
+    # lexbor всегда читает байты как UTF-8, поэтому страницу в другой кодировке
+    # перекодируем в UTF-8 по заголовку Content-Type
+    res = await fetch_body(url)
+    if not res: return None
+    body, charset = res
+    try: is_utf8 = not charset or codecs.lookup(charset).name in ("utf-8", "ascii")
+    except LookupError: is_utf8 = True  # неизвестная кодировка — читаем как UTF-8
+    return body if is_utf8 else body.decode(charset, errors="replace").encode()
+
+def is_retryable(exc: BaseException) -> bool:
+    # Временные сбои: лимит запросов (429), ошибки сервера (5xx), обрыв соединения и таймаут
+    if isinstance(exc, aiohttp.ClientResponseError):
+        return exc.status == 429 or exc.status >= 500
+    return isinstance(exc, (aiohttp.ClientConnectionError, asyncio.TimeoutError))
+
+_WS = re.compile(r"\s+")
 
 def clean_text(text: str) -> str:
-    return " ".join(text.replace("\n", " ").replace("\r", " ").split())
-
-def load_3dnews() -> List[Dict]:
-    html = safe_get("https://3dnews.ru/")
+    return _WS.sub(" ", text).strip()
+
+def make_article(link: str, title: str, summary: str, source: str) -> Dict:
+    return {
+        "id": link_id(link), "title": title, "summary": summary, "link": link, "source": source,
+        "published_parsed": datetime.now(),
+        # Считаем один раз при загрузке — дальше используется только фильтрами
+        "text_lower": f"{title} {summary}".lower(),
+    }
+
+async def load_3dnews() -> List[Dict]:
+    html = await safe_get_html("https://3dnews.ru/")
     if not html: return []
     articles = []
-    for part in html.split('<a href="/')[1:15]:
+    for a in LexborHTMLParser(html).css('a[href^="/"]')[:14]:
         try:
-            href = part[:part.find('"')]
-            title_chunk = part[part.find(">") + 1 : part.find("</a>")]
-            title = clean_text(title_chunk)
+            href = a.attributes["href"]
+            title = clean_text(a.text(separator=" "))
+            if not title: continue
             link = "https://3dnews.ru/" + href.lstrip("/")
-            articles.append({"id": link, "title": title, "summary": "", "link": link, "source": "3DNews", "published_parsed": datetime.now()})
-        except: continue
+            articles.append(make_article(link, title, "", "3DNews"))
+        except (AttributeError, KeyError): continue
     return articles
 
-def load_rss(url: str, source: str) -> List[Dict]:
+async def load_rss(url: str, source: str) -> List[Dict]:
+    # Скачиваем сами (асинхронно), feedparser только разбирает XML
+    xml = await safe_get_bytes(url)
+    if not xml: return []
     articles = []
-    feed = feedparser.parse(url)
+    feed = feedparser.parse(xml)
     for entry in feed.entries[:30]:
         link = entry.get("link", "")
         title = clean_text(entry.get("title") or "")
+        # Анонс чистим только у записей, которые точно попадут в выборку
+        if not (link and title): continue
         summary = clean_text(entry.get("summary") or entry.get("description") or "")[:500]
-        if link and title:
-            articles.append({"id": link, "title": title, "summary": summary, "link": link, "source": source, "published_parsed": datetime.now()})
+        articles.append(make_article(link, title, summary, source))
     return articles
 
-def load_vc_new() -> List[Dict]:
-    html = safe_get("https://vc.ru/new")
+async def load_vc_new() -> List[Dict]:
+    html = await safe_get_html("https://vc.ru/new")
     if not html: return []
     articles = []
-    for match in re.finditer(r'href="(/[^"]+)"[^>]*>\s*<span[^>]*>([^<]+)</span>', html):
-        link = "https://vc.ru" + match.group(1).lstrip("/")
-        articles.append({"id": link, "title": clean_text(match.group(2)), "summary": "", "link": link, "source": "VC.ru New", "published_parsed": datetime.now()})
+    # Заголовок — <span>, идущий первым внутри ссылки
+    for span in LexborHTMLParser(html).css('a[href^="/"] > span:first-child'):
+        title = clean_text(span.text())
+        if not title: continue
+        link = "https://vc.ru/" + span.parent.attributes["href"].lstrip("/")
+        articles.append(make_article(link, title, "", "VC.ru New"))
         if len(articles) >= 15: break
     return articles
 
-def load_articles_from_sites() -> List[Dict]:
+async def load_articles_from_sites() -> List[Dict]:
+    results = await asyncio.gather(
+        load_3dnews(),
+        load_vc_new(),
+        load_rss("https://xakep.ru/feed/", "Xakep.ru"),
+        load_rss(GITHUB_RSS, "GitHub Trending"),
+        return_exceptions=True,
+    )
     all_arts = []
-    all_arts.extend(load_3dnews())
-    all_arts.extend(load_vc_new())
-    all_arts.extend(load_rss("https://xakep.ru/feed/", "Xakep.ru"))
-    all_arts.extend(load_rss(GITHUB_RSS, "GitHub Trending"))
+    for res in results:
+        if isinstance(res, Exception):
+            print(f"❌ Ошибка загрузки источника: {res}")
+            continue
+        all_arts.extend(res)
     return all_arts
 
 # ============ FILTERING ============
 
-def check_require_keywords(text: str) -> bool:
-    text_lower = text.lower()
-    score = sum(1 for kw in REQUIRE_KEYWORDS if kw in text_lower)
-    return score >= 2 
+# Все списки сканируются за один проход по тексту.
+# Слово может входить сразу в несколько списков (например, "ркн"), поэтому храним набор меток.
+KEYWORD_TAGS: Dict[str, frozenset] = {}
+for tag, words in (("REQ", REQUIRE_KEYWORDS), ("EXC", EXCLUDE_KEYWORDS), ("RU", RUSSIA_KEYWORDS)):
+    for kw in words: KEYWORD_TAGS[kw] = KEYWORD_TAGS.get(kw, frozenset()) | {tag}
+
+# Короткие аббревиатуры ("ai", "ии", "tor", "рф") сравниваются только как целые слова:
+# подстрокой они находятся внутри обычных слов ("информации", "editor", "said").
+# Остальные ключи — основы слов ("российск", "вредонос") и фразы, их ищем подстрокой.
+TOKEN_KEYWORDS = frozenset(kw for kw in KEYWORD_TAGS if len(kw) <= 3 and kw.isalnum())
+SUBSTRING_KEYWORDS = [kw for kw in KEYWORD_TAGS if kw not in TOKEN_KEYWORDS]
+_WORD = re.compile(r"\w+")
+
+if ahocorasick:
+    keyword_automaton = ahocorasick.Automaton()
+    for kw in SUBSTRING_KEYWORDS:
+        keyword_automaton.add_word(kw, (kw, KEYWORD_TAGS[kw]))
+    keyword_automaton.make_automaton()
+
+    def iter_substring_keywords(text: str) -> Iterator[Tuple[str, frozenset]]:
+        for _, match in keyword_automaton.iter(text): yield match
+else:
+    # Без pyahocorasick — одна скомпилированная альтернатива. Lookahead не поглощает текст,
+    # поэтому совпадение ищется с каждой позиции ("сеть" внутри "нейросеть")
+    KEYWORD_RE = re.compile(
+        "(?=(" + "|".join(map(re.escape, sorted(SUBSTRING_KEYWORDS, key=len, reverse=True))) + "))"
+    )
+    # На одной позиции находится только самый длинный ключ; более короткие ключи,
+    # совпавшие там же, — его префиксы ("security" у "security patch")
+    KEYWORD_PREFIXES = {
+        kw: [p for p in SUBSTRING_KEYWORDS if p != kw and kw.startswith(p)] for kw in SUBSTRING_KEYWORDS
+    }
+
+    def iter_substring_keywords(text: str) -> Iterator[Tuple[str, frozenset]]:
+        for m in KEYWORD_RE.finditer(text):
+            kw = m.group(1)
+            yield kw, KEYWORD_TAGS[kw]
+            for p in KEYWORD_PREFIXES[kw]: yield p, KEYWORD_TAGS[p]
+
+def iter_keywords(text: str) -> Iterator[Tuple[str, frozenset]]:
+    for kw in TOKEN_KEYWORDS.intersection(_WORD.findall(text)):
+        yield kw, KEYWORD_TAGS[kw]
+    yield from iter_substring_keywords(text)
 
 def filter_articles(articles: List[Dict]) -> List[Dict]:
     suitable_ru, suitable_world = [], []
+    articles = [e for e in articles if e["id"] not in posted_articles]
     for e in articles:
-        if e["id"] in posted_articles: continue
-        text = f"{e['title']} {e['summary']}".lower()
-        if any(kw in text for kw in EXCLUDE_KEYWORDS): continue
-        if not check_require_keywords(text): continue
-        
-        if any(kw in text for kw in RUSSIA_KEYWORDS): suitable_ru.append(e)
+        required, excluded, is_ru = set(), False, False
+        for kw, tags in iter_keywords(e["text_lower"]):
+            if "EXC" in tags: excluded = True; break
+            if "REQ" in tags: required.add(kw)
+            if "RU" in tags: is_ru = True
+        # Нужно минимум 2 разных ключевых слова из REQUIRE
+        if excluded or len(required) < 2: continue
+
+        if is_ru: suitable_ru.append(e)
         else: suitable_world.append(e)
 
     target = suitable_ru if suitable_ru else suitable_world
@@ -177,7 +337,29 @@ def filter_articles(articles: List[Dict]) -> List[Dict]:
 
 # ============ OPENAI ============
 
-def short_summary(title: str, summary: str, link: str) -> Optional[str]:
+@retry(
+    wait=wait_random_exponential(min=1, max=30), stop=stop_after_attempt(5),
+    retry=retry_if_exception(is_retryable), reraise=True,
+)
+async def chat_completion(prompt: str) -> str:
+    payload = {
+        "model": "gpt-4o-mini",
+        "messages": [{"role": "user", "content": prompt}],
+        "temperature": 0.5,
+    }
+    # Семафор держим только на время запроса, не на время ожидания перед повтором
+    async with openai_semaphore:
+        async with get_session().post(
+            OPENAI_CHAT_URL,
+            headers={"Authorization": f"Bearer {OPENAI_API_KEY}"},
+            json=payload,
+            timeout=aiohttp.ClientTimeout(total=60),
+        ) as resp:
+            resp.raise_for_status()
+            data = await resp.json()
+    return data["choices"][0]["message"]["content"]
+
+async def short_summary(title: str, summary: str, link: str) -> Optional[str]:
     prompt = (
         f"Статья: {title}. {summary}\n\n"
         "Сделай новостной пост для Telegram на русском:\n"
@@ -188,47 +370,54 @@ def short_summary(title: str, summary: str, link: str) -> Optional[str]:
         "- Не упоминай никакие каналы или внешние ссылки."
     )
     try:
-        res = openai_client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.5
-        )
-        core_text = res.choices[0].message.content.strip()
+        core_text = (await chat_completion(prompt)).strip()
         
         # Сборка финального текста с источником и опциональным подвалом из ENV
         final_text = f"{core_text}\n\nИсточник: {link}{FOOTER_TEXT}"
         
         return final_text[:1024]
-    except: return None
+    # ValueError — невалидный JSON в ответе; остальные — неожиданная структура ответа
+    except (*HTTP_ERRORS, ValueError, KeyError, IndexError, TypeError, AttributeError): return None
 
 # ============ IMAGE & POSTING ============
 
-def generate_image(title: str) -> Optional[str]:
+@retry(
+    wait=wait_random_exponential(min=1, max=30), stop=stop_after_attempt(5),
+    retry=retry_if_exception(is_retryable), reraise=True,
+)
+async def fetch_image(url: str) -> Optional[bytes]:
+    async with image_semaphore:
+        async with get_session().get(url, timeout=aiohttp.ClientTimeout(total=60)) as resp:
+            if resp.status == 429 or resp.status >= 500: resp.raise_for_status()
+            return await resp.read() if resp.status == 200 else None
+
+async def generate_image(title: str) -> Optional[bytes]:
     prompt = f"abstract technology concept about: {title[:100]}, clean minimal style, no text"
     try:
         encoded = urllib.parse.quote(prompt)
         url = f"https://image.pollinations.ai/prompt/{encoded}?seed={random.randint(1,99999)}"
-        resp = requests.get(url, timeout=60)
-        if resp.status_code == 200:
-            fname = f"img_{random.randint(1,999)}.jpg"
-            with open(fname, "wb") as f: f.write(resp.content)
-            return fname
-    except: return None
+        return await fetch_image(url)
+    except HTTP_ERRORS: return None
 
 async def autopost():
     clean_old_posts()
-    candidates = filter_articles(load_articles_from_sites())
+    candidates = filter_articles(await load_articles_from_sites())
     if not candidates: return
 
     for art in candidates[:5]:
-        text = short_summary(art["title"], art["summary"], art["link"])
-        if not text: continue
+        # Картинка генерируется параллельно с текстом, но без текста она не нужна —
+        # тогда запрос к pollinations отменяем, не дожидаясь ответа
+        img_task = asyncio.create_task(generate_image(art["title"]))
+        text = await short_summary(art["title"], art["summary"], art["link"])
+        if not text:
+            img_task.cancel()
+            continue
 
         try:
-            img = generate_image(art["title"])
+            img = await img_task
             if img:
-                await bot.send_photo(chat_id=CHANNEL_ID, photo=FSInputFile(img), caption=text)
-                os.remove(img)
+                # Картинка уходит в Telegram прямо из памяти, без временного файла
+                await bot.send_photo(chat_id=CHANNEL_ID, photo=BufferedInputFile(img, filename="img.jpg"), caption=text)
             else:
                 await bot.send_message(chat_id=CHANNEL_ID, text=text)
             
@@ -239,7 +428,9 @@ async def autopost():
 
 async def main():
     try: await autopost()
-    finally: await bot.session.close()
+    finally:
+        await bot.session.close()
+        if http_session: await http_session.close()
 
 if __name__ == "__main__":
     asyncio.run(main())